@@ -1,18 +1,20 @@
 # main.py v1.4.7
 import os
+import sys
 import io
 import json
-import tempfile
 import uuid
 import asyncio
+import hashlib
+import random
+import time
 from typing import Optional, Union, Callable, Any
-from functools import wraps
-import pickle
+from functools import wraps, cached_property
+from collections import OrderedDict
+import orjson
 import base64
-import requests
-import re
+import aiohttp
 import telegram
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
 from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -24,17 +26,8 @@ from telegram.ext import (
     ContextTypes,
 )
 from telegram.error import TimedOut, NetworkError, RetryAfter
-from PIL import Image
-import io
-import urllib.parse
-import shutil
-from pathlib import Path
-from datetime import datetime
-from utils.tools.akibot_tools import print_akibot_logo as logo, clear_screen
+from utils.tools.akibot_tools import print_akibot_logo as logo
 from utils.flask.config_editor import config_editor
-from utils.commands.insta.insta import InstagramDownloader
-from utils.commands.ytb2mp3.ytb2mp3 import YouTubeDownloader
-from utils.commands.web2md.web2md import WebToMarkdownConverter
 from utils.commands.start.start import start_command
 from utils.commands.help.help import help_command
 from utils.commands.clear.clear import clear_command
@@ -42,21 +35,99 @@ from utils.commands.think.think import think_command
 from utils.commands.ytb2transcript.ytb2transcript import handler as transcript_handler
 from utils.commands.jailbreak.jailbreak import jailbreak_command, jailbreak_callback_handler
 
+ACCESS_DENIED_TEMPLATE = (
+    "Access Denied: You do not have permission to use this bot.\n"
+    "Please contact the [developer](https://t.me/<USERNAME>) of this bot to request access.\n"
+    "Your ID: `{user_id}`")
+MAINTENANCE_TEXT = "Access Denied: This feature is currently undergoing maintenance. We expect it to be fully operational shortly. Thank you for your patience. 🛠️\n"
+
+def _read_pickle(file_path: str) -> Any:
+    import pickle  # only needed to migrate legacy histories
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+def _read_jsonl(file_path: str) -> list:
+    records = []
+    with open(file_path, 'rb') as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue  # skip a line torn by an interrupted append
+    return records
+
+def _write_jsonl(file_path: str, records: list, append: bool = False) -> None:
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    data = b"".join(orjson.dumps(record) + b"\n" for record in records)
+    with open(file_path, 'ab+' if append else 'wb') as f:
+        # Terminate a line torn by an interrupted append so it does not swallow
+        # the first new record; reads are positioned, writes always go to the end
+        if append and f.seek(0, os.SEEK_END):
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+
+def _request_key(payload: dict) -> bytes:
+    return hashlib.blake2b(
+        orjson.dumps(payload, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def _to_jpeg_b64(data: bytes) -> str:
+    """Base64-encode an image as JPEG, re-encoding only when it is not JPEG already."""
+    if not data.startswith(b"\xff\xd8"):
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as img:
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, format='JPEG')
+            data = buf.getvalue()
+    return _b64(data)
+
+def _decode_text_document(data: bytes) -> Optional[str]:
+    """Decode a document as text, or return None when it looks binary."""
+    if b"\0" in data[:8192]:
+        return None
+    return data.decode("utf-8", errors="replace")
+
 class Config:
+    CHECK_INTERVAL = 5.0  # seconds between config file modification checks
+
     def __init__(self, config_path: str = "config/config.json"):
         self.config_path = config_path
         self._last_modified = 0
+        self._last_modified_prompt = 0
+        self._prompt_file = None
+        self._last_check = 0.0
         self._config_cache = {}
         
     def _load_config(self) -> None:
-        """Load configuration if file has been modified."""
+        """Load configuration and the system prompt if either file has been modified."""
+        now = time.monotonic()
+        if self._config_cache and now - self._last_check < self.CHECK_INTERVAL:
+            return
+        self._last_check = now
         current_mtime = os.path.getmtime(self.config_path)
         if current_mtime > self._last_modified:
+            system_instructions = self._config_cache.get("system_instructions")
             with open(self.config_path, "r") as f:
                 self._config_cache = json.load(f)
-            with open(self._config_cache["system_prompt_file"], "r") as f:
-                self._config_cache["system_instructions"] = f.read()
+            self._config_cache["system_instructions"] = system_instructions
+            # Stored as strings to match str(user.id) in the access checks
+            self._config_cache["allowed_users"] = frozenset(
+                str(u) for u in self._config_cache["allowed_users"])
+            self._config_cache["safety_settings_payload"] = [
+                {"category": k, "threshold": v}
+                for k, v in self._config_cache["safety_settings"].items()]
             self._last_modified = current_mtime
+        prompt_file = self._config_cache["system_prompt_file"]
+        prompt_mtime = os.path.getmtime(prompt_file)
+        if prompt_file != self._prompt_file or prompt_mtime > self._last_modified_prompt:
+            with open(prompt_file, "r") as f:
+                self._config_cache["system_instructions"] = f.read()
+            self._prompt_file = prompt_file
+            self._last_modified_prompt = prompt_mtime
 
     def _get_config_value(self, key: str) -> Any:
         """Get a config value, reloading if necessary."""
@@ -67,7 +138,7 @@ class Config:
     gemini_api_key = os.getenv("GEMINI_API_KEY")
 
     @property
-    def allowed_users(self) -> list:
+    def allowed_users(self) -> frozenset:
         return self._get_config_value("allowed_users")
 
     @property
@@ -82,70 +153,164 @@ class Config:
     def safety_settings(self) -> dict:
         return self._get_config_value("safety_settings")
 
+    @property
+    def safety_settings_payload(self) -> list:
+        return self._get_config_value("safety_settings_payload")
+
     @property
     def system_instructions(self) -> str:
         return self._get_config_value("system_instructions")
         
 class Chat:
+    MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", "40"))
 
-    def __init__(self, history=None):
+    def __init__(self, history=None, username: Optional[str] = None):
         self.history = history if history else []
+        self.username = username  # names the history directory when flushing on shutdown
+        # History log bookkeeping, see AIBot.save_chat_history
+        self.unsaved = len(self.history)
+        self.log_lines = 0
+        self.rewrite_log = True
+        self.summarizing = False  # set by AIBot while older turns are summarized
+
+    @classmethod
+    def from_log(cls, messages: list, username: Optional[str] = None) -> "Chat":
+        """Rebuild a chat from every message recorded in its history log.
+
+        Nothing is trimmed here; AIBot summarizes a history loaded over the cap.
+        """
+        chat = cls(history=messages, username=username)
+        chat.unsaved = 0
+        chat.log_lines = len(messages)
+        chat.rewrite_log = False
+        return chat
 
-    async def send_message_async(self, content, role="user"):
-        if isinstance(content, str):
-            content = [{"text": content}]
+    def trim(self) -> None:
+        """Keep the system instruction at index 0 plus the most recent turns.
 
-        message = {
-            "role": "user",
-            "parts": content if isinstance(content, list) else [content]
+        A fallback only: AIBot summarizes older turns before this cap is reached,
+        and trimming waits while that summary is pending.
+        """
+        if self.summarizing:
+            return
+        max_messages = self.MAX_HISTORY_TURNS * 2
+        if len(self.history) > max_messages + 1:
+            del self.history[1:-max_messages]
+
+    def pin(self, text: str) -> None:
+        """Add text to the system message at index 0, which trimming and summaries keep."""
+        system_message = self.history[0]
+        self.history[0] = {
+            "role": system_message["role"],
+            "parts": system_message["parts"] + [{"text": text}]
         }
-        self.history.append(message)
-        # return await self.get_response()
-        if role == "user":
-            return await self.get_response()
-        return None
-
-    async def get_response(self):
-        return Response(self.history[-1])  # Latest message
+        self.rewrite_log = True
 
-class Response:
+    async def send_message_async(self, content, role="user") -> None:
+        if isinstance(content, str):
+            parts = [{"text": content}]
+        elif isinstance(content, list):
+            parts = content
+        else:
+            parts = [content]
 
-    def __init__(self, text):
-        self.text = text["parts"][0]["text"] if isinstance(
-            text["parts"][0], dict) else text["parts"][0]
+        self.history.append({"role": "user", "parts": parts})
+        self.unsaved += 1
+        self.trim()
 
 class AIBot:
     MAX_RETRIES = 3
     RETRY_DELAY = 3  # seconds
+    SAVE_DELAY = 2  # seconds to coalesce history saves
+    DENIAL_COOLDOWN = 60  # seconds before a denied user is answered again
+    MAX_CACHED_CHATS = 1000  # chats kept in memory, the rest reload from disk
+    COMPACT_THRESHOLD_CHARS = 100000  # history text size that triggers a summary
+    KEEP_RECENT_MESSAGES = 20  # messages kept verbatim when compacting
+    SUMMARY_PROMPT = (
+        "Summarize the conversation above in at most 200 words. Keep names, facts, "
+        "decisions and open questions the assistant needs to continue the conversation."
+    )
+    SUMMARY_PREFIX = "SUMMARY OF EARLIER CONVERSATION:\n"
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 3600  # seconds
     USER_DATA_ROOT = "data/users"
+    HISTORY_FILENAME = "chat_history.jsonl"
+    LEGACY_HISTORY_FILENAME = "chat_history.pkl"  # migrated to the log on first load
     GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models"
-    INSTAGRAM_URL_REGEX = re.compile(
-        r'(?:https?://)?(?:www\.)?instagram\.com/(?:p/|reel/)([\w-]+)')
+    GEMINI_TIMEOUT = 30  # seconds
+    MAX_CONCURRENT_GEMINI_REQUESTS = 8  # outbound Gemini calls allowed at once
+    MAX_MESSAGE_LENGTH = 4096  # Telegram message limit
+    REPLY_CONTEXT_TEMPLATES = {
+        'text': "CONTEXT: Replying to a message from {role}:\n{content}\n\nNEW MESSAGE:\n{message}",
+        'document': "CONTEXT: Replying to a document from {role}.\nDOCUMENT CONTENT:\n{content}\n\nNEW MESSAGE:\n{message}",
+        'unsupported_document': "CONTEXT: Replying to an unsupported document from {role}.\n\nNEW MESSAGE:\n{message}",
+        'audio': "CONTEXT: Replying to an audio message from {role}.\n\nNEW MESSAGE:\n{message}",
+        'voice': "CONTEXT: Replying to an audio message from {role}.\n\nNEW MESSAGE:\n{message}",
+    }
+    ALLOWED_EXTENSIONS = frozenset({
+        ".txt", ".xml", ".py", ".js", ".html", ".css", ".ps1", ".json",
+        ".md", ".yaml", ".yml", ".ts", ".tsx", ".c", ".cpp", ".h", ".hpp",
+        ".java", ".cs", ".php", ".pl", ".rb", ".sh", ".bat", ".ini",
+        ".log", ".toml", ".rs", ".go", ".r", ".jl", ".lua", ".swift",
+        ".sql", ".asm", ".vb", ".vbs", ".jsx", ".svelte", ".vue", ".scss",
+        ".less", ".tex", ".rmd", ".m", ".scala", ".erl", ".hs", ".f90",
+        ".pas", ".groovy"
+    })
 
     def __init__(self):
         self.config = Config()
-        self.chat_history = {}
-        self.instagram_downloader = InstagramDownloader(
-        )  # Instantiate the InstagramDownloader
-        self.youtube_downloader = YouTubeDownloader()
-        self.YOUTUBE_URL_REGEX = re.compile(
-            r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/)([a-zA-Z0-9_-]+)'
-        )
-        self.web2md_converter = WebToMarkdownConverter()
+        self.chat_history = OrderedDict()
+        self._pending_saves = {}
+        self._active_writes = {}
+        self._compacting = {}
+        self._response_cache = OrderedDict()
+        self._inflight_requests = {}
+        self._denied_at = OrderedDict()
+        self._user_locks = {}
 
         # No need to configure genai library anymore
         self.api_url = f"{self.GEMINI_API_URL}/{self.config.model_name}"
+        self._generate_url = f"{self.api_url}:generateContent?key={self.config.gemini_api_key}"
         self.headers = {"Content-Type": "application/json"}
-
-        self.allowed_extensions = {
-            ".txt", ".xml", ".py", ".js", ".html", ".css", ".ps1", ".json",
-            ".md", ".yaml", ".yml", ".ts", ".tsx", ".c", ".cpp", ".h", ".hpp",
-            ".java", ".cs", ".php", ".pl", ".rb", ".sh", ".bat", ".ini",
-            ".log", ".toml", ".rs", ".go", ".r", ".jl", ".lua", ".swift",
-            ".sql", ".asm", ".vb", ".vbs", ".jsx", ".svelte", ".vue", ".scss",
-            ".less", ".tex", ".rmd", ".m", ".scala", ".erl", ".hs", ".f90",
-            ".pas", ".groovy"
-        }
+        self._gemini_session: Optional[aiohttp.ClientSession] = None
+        self.gemini_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_GEMINI_REQUESTS)
+
+    # Command helpers are built, and their heavy modules imported, on first use
+    @cached_property
+    def instagram_downloader(self):
+        from utils.commands.insta.insta import InstagramDownloader
+        return InstagramDownloader()
+
+    @cached_property
+    def youtube_downloader(self):
+        from utils.commands.ytb2mp3.ytb2mp3 import YouTubeDownloader
+        return YouTubeDownloader()
+
+    @cached_property
+    def web2md_converter(self):
+        from utils.commands.web2md.web2md import WebToMarkdownConverter
+        return WebToMarkdownConverter()
+
+    @staticmethod
+    def is_allowed_ext(name: Optional[str]) -> bool:
+        """Whether a document name has one of the supported text extensions."""
+        return os.path.splitext(name or "")[1].lower() in AIBot.ALLOWED_EXTENSIONS
+
+    @staticmethod
+    def iter_chunks(text: str, size: int = MAX_MESSAGE_LENGTH):
+        """Yield (start, end) offsets of consecutive chunks of text."""
+        start = 0
+        length = len(text)
+        while start < length:
+            yield start, min(start + size, length)
+            start += size
+
+    def get_user_lock(self, user_id: str) -> asyncio.Lock:
+        """Lock that serializes history updates for one user under concurrent updates."""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
 
     def get_user_dir(self, user_id: str, username: str) -> str:
         """Get base directory for user data."""
@@ -166,46 +331,78 @@ class AIBot:
         )
         history_dir = os.path.join(user_dir, "history")
         os.makedirs(history_dir, exist_ok=True)
-        return os.path.join(history_dir, "chat_history.pkl")
-
-    async def load_chat_history(self, user_id: str, username: str) -> Optional[list]:
-        """Load chat history from new directory structure."""
-        file_path = self.get_history_file_path(user_id, username)
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                print(f"Error loading history: {e}")
-        return None
-
-    async def generate_content(self, contents, stream=False):
-        endpoint = "streamGenerateContent" if stream else "generateContent"
-        url = f"{self.api_url}:{endpoint}?{'alt=sse&' if stream else ''}key={self.config.gemini_api_key}"       
+        return os.path.join(history_dir, self.HISTORY_FILENAME)
+
+    def get_gemini_session(self) -> aiohttp.ClientSession:
+        """Return the shared Gemini HTTP session, creating it on first use."""
+        if self._gemini_session is None or self._gemini_session.closed:
+            self._gemini_session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=32, keepalive_timeout=75, ttl_dns_cache=300,
+                    enable_cleanup_closed=True),
+                timeout=aiohttp.ClientTimeout(total=self.GEMINI_TIMEOUT, sock_connect=5))
+        return self._gemini_session
+
+    async def close_gemini_session(self) -> None:
+        """Close the shared Gemini HTTP session."""
+        if self._gemini_session is not None and not self._gemini_session.closed:
+            await self._gemini_session.close()
+
+    async def shutdown(self, application: Application) -> None:
+        """Flush unsaved history and release resources on shutdown."""
+        writes = list(self._active_writes.values())
+        pending = list(self._pending_saves.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, *writes, return_exceptions=True)
+        for user_id, chat in list(self.chat_history.items()):
+            if chat.unsaved or chat.rewrite_log:
+                await self.save_chat_history(user_id, chat.username, chat)
+        await self.close_gemini_session()
+
+    async def generate_content(self, contents):
+        url = self._generate_url
         payload = {
-            "contents":
-            contents,
-            "safetySettings": [{
-                "category": k,
-                "threshold": v
-            } for k, v in self.config.safety_settings.items()],
-            "generationConfig":
-            self.config.generation_config
+            "contents": contents,
+            "safetySettings": self.config.safety_settings_payload,
+            "generationConfig": self.config.generation_config
         }
         
+        # Only deterministic (temperature 0) requests can repeat, so only they pay
+        # for hashing the whole history to hit the cache or share an in-flight call
+        if payload["generationConfig"].get("temperature") != 0:
+            return await self._post_generate_content(url, payload)
+        request_key = await asyncio.to_thread(_request_key, payload)
+        cached = self._response_cache.get(request_key)
+        if cached and cached[0] > time.monotonic():
+            self._response_cache.move_to_end(request_key)
+            return cached[1]
+        
+        task = self._inflight_requests.get(request_key)
+        if task is None:
+            task = asyncio.create_task(self._post_generate_content(url, payload))
+            self._inflight_requests[request_key] = task
+            task.add_done_callback(lambda _: self._inflight_requests.pop(request_key, None))
+        result = await asyncio.shield(task)
+        self._cache_response(request_key, result)
+        return result
+
+    async def _post_generate_content(self, url: str, payload: dict):
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            
-            if stream:
-                # Handle streaming response
-                return response.iter_lines()
-            else:
-                return response.json()
-        except requests.exceptions.RequestException as e:
+            async with self.gemini_semaphore, self.get_gemini_session().post(url, json=payload) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"Error making request to Gemini API: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}")
             raise
 
+    def _cache_response(self, cache_key: bytes, response: dict) -> None:
+        self._response_cache[cache_key] = (time.monotonic() + self.RESPONSE_CACHE_TTL, response)
+        self._response_cache.move_to_end(cache_key)
+        while len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+
     async def handle_gemini_response(self, response):
         """Handle Gemini API response and extract text content."""
         try:
@@ -234,15 +431,17 @@ class AIBot:
             except (TimedOut, NetworkError) as e:
                 if attempt == self.MAX_RETRIES - 1:
                     raise
-                delay = self.RETRY_DELAY * (2**attempt)
+                # Jitter keeps callers that failed together from retrying in lockstep
+                delay = self.RETRY_DELAY * (2**attempt) * (0.5 + random.random())
                 print(
-                    f"Operation failed with {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}, retrying in {delay} seconds..."
+                    f"Operation failed with {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}, retrying in {delay:.1f} seconds..."
                 )
                 await asyncio.sleep(delay)
             except RetryAfter as e:
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
                 print(f"Rate limited, waiting {e.retry_after} seconds...")
-                await asyncio.sleep(e.retry_after)
-                return await operation(*args, **kwargs)
+                await asyncio.sleep(e.retry_after + random.random())
 
     def check_user_access(func: Callable) -> Callable:
         """Decorator to check user access permissions."""
@@ -252,12 +451,13 @@ class AIBot:
                           context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
             user_id = str(update.effective_user.id)
             if user_id not in self.config.allowed_users:
-                await self.retry_operation(
-                    update.message.reply_text,
-                    f"Access Denied: You do not have permission to use this bot.\n"
-                    f"Please contact the [developer](https://t.me/<USERNAME>) of this bot to request access.\n"
-                    f"Your ID: `{user_id}`",
-                    parse_mode='Markdown')
+                if self.should_notify_denial(user_id):
+                    try:
+                        await update.message.reply_text(
+                            ACCESS_DENIED_TEMPLATE.format(user_id=user_id),
+                            parse_mode='Markdown')
+                    except Exception as e:
+                        print(f"Error sending access denial: {e}")
                 return
             return await func(self, update, context, *args, **kwargs)
 
@@ -271,15 +471,28 @@ class AIBot:
                           context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
             user_id = str(update.effective_user.id)
             if user_id not in []:
-                await self.retry_operation(
-                    update.message.reply_text,
-                    f"Access Denied: This feature is currently undergoing maintenance. We expect it to be fully operational shortly. Thank you for your patience. 🛠️\n",
-                    parse_mode='Markdown')
+                if self.should_notify_denial(user_id):
+                    try:
+                        await update.message.reply_text(MAINTENANCE_TEXT, parse_mode='Markdown')
+                    except Exception as e:
+                        print(f"Error sending access denial: {e}")
                 return
             return await func(self, update, context, *args, **kwargs)
 
         return wrapper
 
+    def should_notify_denial(self, user_id: str) -> bool:
+        """Answer a denied user at most once per DENIAL_COOLDOWN."""
+        now = time.monotonic()
+        if now - self._denied_at.get(user_id, float("-inf")) < self.DENIAL_COOLDOWN:
+            return False
+        self._denied_at[user_id] = now
+        self._denied_at.move_to_end(user_id)
+        # Entries are ordered by time, so expired ones are all at the front
+        while now - next(iter(self._denied_at.values())) >= self.DENIAL_COOLDOWN:
+            self._denied_at.popitem(last=False)
+        return True
+
     # New helper method for info files
     def get_info_file_path(self, user_id: str, username: str, filename: str) -> str:
         """Get path for user info files."""
@@ -290,55 +503,211 @@ class AIBot:
 
     async def load_chat_history(self, user_id: str,
                                 username: str) -> Optional[list]:
-        """Load chat history from a pickle file if it exists."""
+        """Load every logged message, migrating a legacy pickle if needed."""
         file_path = self.get_history_file_path(user_id, username)
         if os.path.exists(file_path):
             try:
-                with open(file_path, 'rb') as f:
-                    history_data = pickle.load(f)
-                    return history_data
+                return await asyncio.to_thread(_read_jsonl, file_path)
             except Exception as e:
                 print(f"Error loading chat history from {file_path}: {e}")
                 return None
+        legacy_path = os.path.join(os.path.dirname(file_path), self.LEGACY_HISTORY_FILENAME)
+        if os.path.exists(legacy_path):
+            try:
+                history = await asyncio.to_thread(_read_pickle, legacy_path)
+                await asyncio.to_thread(_write_jsonl, file_path, history)
+                os.remove(legacy_path)
+                return history
+            except Exception as e:
+                print(f"Error migrating chat history from {legacy_path}: {e}")
+                return None
         return None
 
-    async def save_chat_history(self, user_id: str, username: str) -> None:
-        """Save chat history to user-specific directory."""
+    async def save_chat_history(self, user_id: str, username: str,
+                                chat: Optional[Chat] = None) -> bool:
+        """Append new messages to the user's history log.
+
+        The log is rewritten from the live history when that history was edited
+        (compaction) or once trimmed turns make the log twice as long as needed.
+        Returns False when the write failed.
+        """
+        chat = chat or self.chat_history[user_id]
+        history_length = len(chat.history)
+        rewrite = (chat.rewrite_log or chat.unsaved >= history_length
+                   or chat.log_lines + chat.unsaved > 2 * history_length)
+        if not rewrite and not chat.unsaved:
+            return True
         file_path = self.get_history_file_path(user_id, username)
+        # Snapshot on the event loop so the thread never sees a list being appended to
+        records = list(chat.history) if rewrite else chat.history[-chat.unsaved:]
+        chat.unsaved = 0
+        chat.rewrite_log = False
+        # The write is tracked so /clear and shutdown can wait for it; cancelling
+        # the awaiting task would not stop the worker thread
+        write = asyncio.ensure_future(
+            asyncio.to_thread(_write_jsonl, file_path, records, not rewrite))
+        self._active_writes[user_id] = write
         try:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as f:
-                pickle.dump(self.chat_history[user_id].history, f)
+            await asyncio.shield(write)
+            chat.log_lines = len(records) if rewrite else chat.log_lines + len(records)
+            return True
         except Exception as e:
+            chat.rewrite_log = True
             print(f"Error saving chat history: {e}")
+            return False
+        finally:
+            if self._active_writes.get(user_id) is write:
+                del self._active_writes[user_id]
             
-    async def initialize_chat(self, user_id: str, username: str) -> None:
-        """Initialize chat history for a user if not exists."""
-        if user_id not in self.chat_history:
-            loaded_history = await self.load_chat_history(user_id, username)
-            if loaded_history:
-                self.chat_history[user_id] = Chat(history=loaded_history)
-            else:
-                self.chat_history[user_id] = Chat(history=[])
-                await self.retry_operation(
-                    self.chat_history[user_id].send_message_async,
-                    self.config.system_instructions,
-                    role="system")
-
-    async def process_file(self, message: Message, process_func: Callable) -> Optional[str]:
-        """Generic file processing with cleanup and retry logic."""
-        temp_file = None
+    def schedule_save_chat_history(self, user_id: str, username: str, chat: Chat) -> None:
+        """Save chat history in the background, coalescing saves within SAVE_DELAY."""
+        if user_id not in self._pending_saves:
+            self._pending_saves[user_id] = asyncio.create_task(
+                self._deferred_save_chat_history(user_id, username, chat))
+
+    async def _deferred_save_chat_history(self, user_id: str, username: str,
+                                          chat: Chat) -> None:
+        # The chat is captured up front so a save still lands if it gets evicted.
+        # Messages, pins and summaries added while a write runs are picked up by
+        # another round; failed writes are retried with backoff up to MAX_RETRIES.
+        failures = 0
+        try:
+            while True:
+                await asyncio.sleep(self.SAVE_DELAY * 2 ** failures)
+                if await self.save_chat_history(user_id, username, chat):
+                    failures = 0
+                elif failures == self.MAX_RETRIES:
+                    break
+                else:
+                    failures += 1
+                if not (chat.unsaved or chat.rewrite_log):
+                    break
+        finally:
+            if self._pending_saves.get(user_id) is asyncio.current_task():
+                del self._pending_saves[user_id]
+
+    async def cancel_pending_save(self, user_id: str) -> None:
+        """Drop a scheduled history save and wait out a write already in progress."""
+        write = self._active_writes.get(user_id)
+        task = self._pending_saves.pop(user_id, None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if write:
+            await asyncio.gather(write, return_exceptions=True)
+
+    def schedule_compact_chat_history(self, user_id: str, username: str, chat: Chat) -> None:
+        """Summarize older turns in the background once the history grows large."""
+        if user_id in self._compacting:
+            return
+        if len(chat.history) <= self.KEEP_RECENT_MESSAGES + 1:
+            return
+        # Summarize before Chat.trim's cap is reached so no turn is dropped unsummarized
+        compact_at = 2 * Chat.MAX_HISTORY_TURNS - self.KEEP_RECENT_MESSAGES
+        if len(chat.history) - 1 <= compact_at:
+            history_chars = sum(len(part.get("text", "")) for message in chat.history
+                                for part in message["parts"])
+            if history_chars < self.COMPACT_THRESHOLD_CHARS:
+                return
+        chat.summarizing = True
+        self._compacting[user_id] = asyncio.create_task(
+            self._compact_chat_history(user_id, username, chat))
+
+    async def _compact_chat_history(self, user_id: str, username: str, chat: Chat) -> None:
+        # The summary is kept as the last part of the pinned system message so it
+        # survives history trimming and the system text stays an unchanged prefix
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                await self.retry_operation(process_func, temp_file.name)
-                return await self.handle_processed_file(temp_file.name, message)
+            system_message = chat.history[0]
+            old_messages = chat.history[1:-self.KEEP_RECENT_MESSAGES]
+            previous_summary = [part for part in system_message["parts"]
+                                if part.get("text", "").startswith(self.SUMMARY_PREFIX)]
+            response = await self.generate_content(old_messages + [{
+                "role": "user",
+                "parts": previous_summary + [{"text": self.SUMMARY_PROMPT}]
+            }])
+            summary = await self.handle_gemini_response(response)
+
+            summarized = {id(message) for message in old_messages}
+            chat.history[1:] = [message for message in chat.history[1:]
+                                if id(message) not in summarized]
+            # Re-read the system message: a prompt may have been pinned meanwhile
+            system_message = chat.history[0]
+            chat.history[0] = {
+                "role": system_message["role"],
+                "parts": [part for part in system_message["parts"]
+                          if not part.get("text", "").startswith(self.SUMMARY_PREFIX)]
+                         + [{"text": f"{self.SUMMARY_PREFIX}{summary}"}]
+            }
+            chat.rewrite_log = True
+            if self.chat_history.get(user_id) is chat:
+                self.schedule_save_chat_history(user_id, username, chat)
         except Exception as e:
-            return f"An error occurred: {str(e).replace(self.config.gemini_api_key, '[REDACTED TOKEN]')}"
+            print(f"Error compacting chat history: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}")
         finally:
-            if temp_file and os.path.exists(temp_file.name):
-                os.remove(temp_file.name)
+            self._compacting.pop(user_id, None)
+            # Only turns a failed summary could not cover are dropped
+            chat.summarizing = False
+            chat.trim()
+
+    async def initialize_chat(self, user_id: str, username: str) -> Chat:
+        """Return the user's chat, loading or creating it if not cached.
+
+        Callers hold the user's lock so the chat cannot be replaced underneath them.
+        """
+        chat = self.chat_history.get(user_id)
+        if chat is not None:
+            self.chat_history.move_to_end(user_id)
+            return chat
+        loaded_history = await self.load_chat_history(user_id, username)
+        if loaded_history:
+            chat = Chat.from_log(loaded_history, username)
+        else:
+            chat = Chat(history=[], username=username)
+            await self.retry_operation(
+                chat.send_message_async,
+                self.config.system_instructions,
+                role="system")
+        self.chat_history[user_id] = chat
+        if loaded_history:
+            # A log over the cap (e.g. a migrated pickle) is summarized, not cut
+            self.schedule_compact_chat_history(user_id, username, chat)
+        self.evict_idle_chats()
+        return chat
+
+    def evict_idle_chats(self) -> None:
+        """Evict least recently used chats that no handler, save or summary is using.
+
+        A chat whose history is not fully on disk (a failed write) is kept and
+        its save is scheduled again, so eviction never drops turns.
+        """
+        excess = len(self.chat_history) - self.MAX_CACHED_CHATS
+        if excess <= 0:
+            return
+        victims = []
+        for old_id, old_chat in self.chat_history.items():
+            if len(victims) == excess:
+                break
+            lock = self._user_locks.get(old_id)
+            if ((lock is not None and lock.locked()) or old_id in self._pending_saves
+                    or old_id in self._compacting):
+                continue
+            if old_chat.unsaved or old_chat.rewrite_log:
+                self.schedule_save_chat_history(old_id, old_chat.username, old_chat)
+                continue
+            victims.append(old_id)
+        for old_id in victims:
+            del self.chat_history[old_id]
+            self._user_locks.pop(old_id, None)
+
+    async def process_file(self, message: Message, download: Callable, chat: Chat) -> Optional[str]:
+        """Generic file processing with retry logic; files are downloaded into memory."""
+        try:
+            data = await self.retry_operation(download)
+            return await self.handle_processed_file(data, message, chat)
+        except Exception as e:
+            return f"An error occurred: {str(e).replace(self.config.gemini_api_key, '[REDACTED TOKEN]')}"
     
-    async def handle_processed_file(self, file_path: str, message: Message) -> str:
+    async def handle_processed_file(self, data: bytearray, message: Message, chat: Chat) -> str:
         """Handle the processed file and get AI response with retry logic."""
         user_id = str(message.from_user.id)
         username = str(message.from_user.username)
@@ -346,57 +715,54 @@ class AIBot:
     
         try:
             if message.photo:
-                with Image.open(file_path) as img:
-                    buf = io.BytesIO()
-                    img.save(buf, format='JPEG')
-                    img_b64 = base64.b64encode(buf.getvalue()).decode()
-                    content = [{
-                        "text": f"user: {caption}"
-                    }, {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": img_b64
-                        }
-                    }]
+                img_b64 = await asyncio.to_thread(_to_jpeg_b64, data)
+                content = [{
+                    "text": f"user: {caption}"
+                }, {
+                    "inline_data": {
+                        "mime_type": "image/jpeg",
+                        "data": img_b64
+                    }
+                }]
             elif message.document:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = [{
-                        "text": f"user: {caption}"
-                    }, {
-                        "text": f.read()
-                    }]
+                document_text = await asyncio.to_thread(_decode_text_document, data)
+                if document_text is None:
+                    return "Unsupported file type"
+                content = [{
+                    "text": f"user: {caption}"
+                }, {
+                    "text": document_text
+                }]
             elif message.audio or message.voice:
                 audio_msg = message.audio or message.voice
-                with open(file_path, "rb") as f:
-                    audio_b64 = base64.b64encode(f.read()).decode()
+                audio_b64 = await asyncio.to_thread(_b64, data)
+                
+                # Include audio metadata
+                duration = audio_msg.duration
+                file_size = audio_msg.file_size
+                mime_type = "audio/ogg"
+                if message.audio:
+                    mime_type = message.audio.mime_type or mime_type
                     
-                    # Include audio metadata
-                    duration = audio_msg.duration
-                    file_size = audio_msg.file_size
-                    mime_type = "audio/ogg"
-                    if message.audio:
-                        mime_type = message.audio.mime_type or mime_type
-                        
-                    content = [{
-                        "text": f"user: Audio message - Duration: {duration}s, Size: {file_size} bytes\nCaption: {caption}"
-                    }, {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": audio_b64
-                        }
-                    }]
+                content = [{
+                    "text": f"user: Audio message - Duration: {duration}s, Size: {file_size} bytes\nCaption: {caption}"
+                }, {
+                    "inline_data": {
+                        "mime_type": mime_type,
+                        "data": audio_b64
+                    }
+                }]
             else:
                 return "Unsupported file type"
     
-            # Get the chat history for the user
-            chat = self.chat_history[user_id]
             await chat.send_message_async(content, role="user")
     
             response = await self.generate_content(chat.history)
             text_response = await self.handle_gemini_response(response)
             
             await chat.send_message_async(f"{text_response}", role="assistant")
-            await self.save_chat_history(user_id, username)
+            self.schedule_save_chat_history(user_id, username, chat)
+            self.schedule_compact_chat_history(user_id, username, chat)
             return text_response
         except Exception as e:
             return f"Error processing file: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}"
@@ -512,32 +878,23 @@ class AIBot:
                 result['type'] = 'text'
             elif replied_msg.photo:
                 file_obj = await self.retry_operation(replied_msg.photo[-1].get_file)
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                    await file_obj.download_to_drive(temp_file.name)
-                    try:
-                        with Image.open(temp_file.name) as img:
-                            buf = io.BytesIO()
-                            img.save(buf, format='JPEG')
-                            img_b64 = base64.b64encode(buf.getvalue()).decode()
-                            result['content'] = [{  # Enclose in a list for consistency
-                                "text": "[Image]",
-                                "image_data": img_b64,
-                                "caption": replied_msg.caption or ""
-                            }]
-                            result['type'] = 'image'
-                    finally:
-                        os.unlink(temp_file.name)
+                data = await self.retry_operation(file_obj.download_as_bytearray)
+                img_b64 = await asyncio.to_thread(_to_jpeg_b64, data)
+                result['content'] = [{  # Enclose in a list for consistency
+                    "text": "[Image]",
+                    "image_data": img_b64,
+                    "caption": replied_msg.caption or ""
+                }]
+                result['type'] = 'image'
             elif replied_msg.document:
-                if replied_msg.document.file_name.endswith(tuple(self.allowed_extensions)):
+                document_text = None
+                if self.is_allowed_ext(replied_msg.document.file_name):
                     file_obj = await self.retry_operation(replied_msg.document.get_file)
-                    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                        await file_obj.download_to_drive(temp_file.name)
-                        try:
-                            with open(temp_file.name, 'r', encoding='utf-8') as f:
-                                result['content'] = f.read()
-                                result['type'] = 'document'
-                        finally:
-                            os.unlink(temp_file.name)
+                    data = await self.retry_operation(file_obj.download_as_bytearray)
+                    document_text = await asyncio.to_thread(_decode_text_document, data)
+                if document_text is not None:
+                    result['content'] = document_text
+                    result['type'] = 'document'
                 else:
                     result['content'] = "[Unsupported Document]"
                     result['type'] = 'unsupported_document'
@@ -581,29 +938,14 @@ class AIBot:
                 print(f"Error formatting image reply context: {e}")
                 return f"Error processing image reply.  New message:\n{current_message}"
 
-        elif reply_info['type'] == 'document':
-            return (
-                f"CONTEXT: Replying to a document from {role_label}.\n"
-                f"DOCUMENT CONTENT:\n{reply_info['content']}\n\n"
-                f"NEW MESSAGE:\n{current_message}"
-            )
-        elif reply_info['type'] == 'unsupported_document':
-            return (
-                f"CONTEXT: Replying to an unsupported document from {role_label}.\n\n"
-                f"NEW MESSAGE:\n{current_message}"
-            )
-
-        elif reply_info['type'] in ('audio', 'voice'):  # Handle other types as needed
-            return (
-                f"CONTEXT: Replying to an audio message from {role_label}.\n\n"
-                f"NEW MESSAGE:\n{current_message}"
-            )        
-        else: # Default for text or other simple messages
-            return (
-                f"CONTEXT: Replying to a message from {role_label}:\n"
-                f"{reply_info['content']}\n\n"
-                f"NEW MESSAGE:\n{current_message}"
-            )
+        # Text, documents, audio and any other simple message types
+        template = self.REPLY_CONTEXT_TEMPLATES.get(
+            reply_info['type'], self.REPLY_CONTEXT_TEMPLATES['text'])
+        return template.format(
+            role=role_label,
+            content=reply_info['content'],
+            message=current_message
+        )
        
     async def send_response_with_toggle(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                                          text: str, reply_to_message_id: int = None, 
@@ -613,17 +955,24 @@ class AIBot:
             if 'message_cache' not in context.chat_data:
                 context.chat_data['message_cache'] = {}
                 
-            # Determine the correct message and reply method based on update type
+            # Resolve the send call once based on update type
             if update.callback_query:
-                # For callback queries
+                # For callback queries, edit existing message
                 message = update.callback_query.message
-                reply_method = message.edit_text
-                chat_id = message.chat_id
+                send = lambda chunk, chunk_markup, reply_id: context.bot.edit_message_text(
+                    chat_id=message.chat_id,
+                    message_id=message.message_id,
+                    text=chunk,
+                    reply_markup=chunk_markup
+                )
             else:
-                # For regular messages
+                # For regular messages, reply
                 message = update.message
-                reply_method = message.reply_text
-                chat_id = message.chat_id
+                send = lambda chunk, chunk_markup, reply_id: message.reply_text(
+                    chunk,
+                    reply_to_message_id=reply_id,
+                    reply_markup=chunk_markup
+                )
             
             # Generate unique callback data if not using a custom reply markup
             if not reply_markup:
@@ -639,51 +988,20 @@ class AIBot:
             
             sent_messages = []
             
-            # Handle messages longer than 4096 characters
-            if len(text) > 4096:
-                chunks = [text[i:i+4096] for i in range(0, len(text), 4096)]
-                
-                for i, chunk in enumerate(chunks):
-                    chunk_markup = None
-                    if i == len(chunks) - 1:  # Only add button to last chunk
-                        chunk_markup = reply_markup
-                    
-                    if update.callback_query:
-                        # For callback queries, edit existing message
-                        sent_msg = await self.retry_operation(
-                            context.bot.edit_message_text,
-                            chat_id=chat_id,
-                            message_id=message.message_id,
-                            text=chunk,
-                            reply_markup=chunk_markup
-                        )
-                    else:
-                        # For regular messages, reply
-                        sent_msg = await self.retry_operation(
-                            reply_method,
-                            chunk,
-                            reply_to_message_id=reply_to_message_id if i == 0 else None,
-                            reply_markup=chunk_markup
-                        )
-                    sent_messages.append(sent_msg)
+            # Only split messages longer than 4096 characters
+            text_length = len(text)
+            if text_length > self.MAX_MESSAGE_LENGTH:
+                chunk_bounds = self.iter_chunks(text)
             else:
-                if update.callback_query:
-                    # For callback queries, edit existing message
-                    sent_msg = await self.retry_operation(
-                        context.bot.edit_message_text,
-                        chat_id=chat_id,
-                        message_id=message.message_id,
-                        text=text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    # For regular messages, reply
-                    sent_msg = await self.retry_operation(
-                        reply_method,
-                        text,
-                        reply_to_message_id=reply_to_message_id,
-                        reply_markup=reply_markup
-                    )
+                chunk_bounds = ((0, text_length),)
+            
+            for start, end in chunk_bounds:
+                sent_msg = await self.retry_operation(
+                    send,
+                    text[start:end],
+                    reply_markup if end == text_length else None,  # Only add button to last chunk
+                    reply_to_message_id if start == 0 else None
+                )
                 sent_messages.append(sent_msg)
             
             # Store message data in context
@@ -710,93 +1028,94 @@ class AIBot:
     @check_user_access    
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
-        user_id = str(update.effective_user.id)
-        username = str(update.effective_user.username)
-        await self.initialize_chat(user_id, username)
-    
-        text = update.message.text
+        user = update.effective_user
+        message = update.message
+        user_id = str(user.id)
+        username = str(user.username)
+        # Updates run concurrently; one user's turns still run one at a time, in order
+        async with self.get_user_lock(user_id):
+            chat = await self.initialize_chat(user_id, username)
         
-        if 'transcript_state' in context.chat_data:
-            await transcript_handler.process_transcript_steps(self, update, context)
-            return        
-        
-        try:
-            chat = self.chat_history[user_id]
+            text = message.text
+            
+            if 'transcript_state' in context.chat_data:
+                await transcript_handler.process_transcript_steps(self, update, context)
+                return        
             
             try:
-                reply_info = await self.get_replied_message_content(update.message)
-            except ValueError as ve:
-                await self.send_response_with_toggle(update, context, "Cannot reply to voice or audio messages")
-                return
+                try:
+                    reply_info = await self.get_replied_message_content(message)
+                except ValueError as ve:
+                    await self.send_response_with_toggle(update, context, "Cannot reply to voice or audio messages")
+                    return
+                    
+                if reply_info:
+                    formatted_context = self.format_reply_context(reply_info, text)
+                    await chat.send_message_async(formatted_context, role="user")
+                else:
+                    await chat.send_message_async(f"user: {text}", role="user")
                 
-            if reply_info:
-                formatted_context = self.format_reply_context(reply_info, text)
-                await chat.send_message_async(formatted_context, role="user")
-            else:
-                await chat.send_message_async(f"user: {text}", role="user")
-            
-            response = await self.retry_operation(
-                self.generate_content,
-                chat.history,
-                stream=False
-            )
-            
-            text_response = await self.handle_gemini_response(response)                        
-            await chat.send_message_async(f"{text_response}", role="assistant")
-            await self.save_chat_history(user_id, username)
-            
-            # Use the new utility method to send the response
-            await self.send_response_with_toggle(update, context, text_response)
+                response = await self.retry_operation(
+                    self.generate_content,
+                    chat.history
+                )
                 
-        except Exception as e:
-            error_message = f"An error occurred: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}"
-            await self.send_response_with_toggle(update, context, error_message)
+                text_response = await self.handle_gemini_response(response)                        
+                await chat.send_message_async(f"{text_response}", role="assistant")
+                self.schedule_save_chat_history(user_id, username, chat)
+                self.schedule_compact_chat_history(user_id, username, chat)
+                
+                # Use the new utility method to send the response
+                await self.send_response_with_toggle(update, context, text_response)
+                    
+            except Exception as e:
+                error_message = f"An error occurred: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}"
+                await self.send_response_with_toggle(update, context, error_message)
 
     @check_user_access    
     async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
-        user_id = str(update.effective_user.id)
-        username = str(update.effective_user.username)
-        await self.initialize_chat(user_id, username)
-    
-        try:
-            if not (update.message.voice or update.message.audio):
-                reply_info = await self.get_replied_message_content(update.message)
-                
-                if reply_info:
-                    formatted_context = self.format_reply_context(
-                        reply_info,
-                        update.message.caption or "[No caption]"
-                    )
+        user = update.effective_user
+        message = update.message
+        user_id = str(user.id)
+        username = str(user.username)
+        audio = message.voice or message.audio
+        async with self.get_user_lock(user_id):
+            chat = await self.initialize_chat(user_id, username)
+        
+            try:
+                if not audio:
+                    reply_info = await self.get_replied_message_content(message)
                     
-                    if isinstance(formatted_context, list):
-                        await self.chat_history[user_id].send_message_async(formatted_context, role="user")
-                    else:
-                        await self.chat_history[user_id].send_message_async(formatted_context, role="user")
-    
-            # Handle different media types
-            if update.message.voice or update.message.audio:
-                file_obj = await self.retry_operation((update.message.voice or update.message.audio).get_file)
-                result = await self.process_file(update.message, lambda path: file_obj.download_to_drive(path))
-            elif update.message.photo:
-                file_obj = await self.retry_operation(update.message.photo[-1].get_file)
-                result = await self.process_file(update.message, lambda path: file_obj.download_to_drive(path))
-            elif update.message.document:
-                file_extension = os.path.splitext(update.message.document.file_name)[1].lower()
-                if file_extension not in self.allowed_extensions:
-                    await self.send_response_with_toggle(update, context, "Unsupported document type.")
-                    return
-                file_obj = await self.retry_operation(update.message.document.get_file)
-                result = await self.process_file(update.message, lambda path: file_obj.download_to_drive(path))
-            else:
-                result = "Unsupported media type"
-    
-            # Use the new utility method to send the response
-            await self.send_response_with_toggle(update, context, result)
-                
-        except Exception as e:
-            error_message = f"Error handling media: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}"
-            await self.send_response_with_toggle(update, context, error_message)
+                    if reply_info:
+                        formatted_context = self.format_reply_context(
+                            reply_info,
+                            message.caption or "[No caption]"
+                        )
+                        await chat.send_message_async(formatted_context, role="user")
+        
+                # Handle different media types
+                if audio:
+                    file_obj = await self.retry_operation(audio.get_file)
+                    result = await self.process_file(message, file_obj.download_as_bytearray, chat)
+                elif message.photo:
+                    file_obj = await self.retry_operation(message.photo[-1].get_file)
+                    result = await self.process_file(message, file_obj.download_as_bytearray, chat)
+                elif message.document:
+                    if not self.is_allowed_ext(message.document.file_name):
+                        await self.send_response_with_toggle(update, context, "Unsupported document type.")
+                        return
+                    file_obj = await self.retry_operation(message.document.get_file)
+                    result = await self.process_file(message, file_obj.download_as_bytearray, chat)
+                else:
+                    result = "Unsupported media type"
+        
+                # Use the new utility method to send the response
+                await self.send_response_with_toggle(update, context, result)
+                    
+            except Exception as e:
+                error_message = f"Error handling media: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}"
+                await self.send_response_with_toggle(update, context, error_message)
     
     async def toggle_markdown_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle the Markdown toggle button callback."""
@@ -829,8 +1148,10 @@ class AIBot:
             ]])
     
             # Update all messages in the chain
-            chunks = [text[i:i+4096] for i in range(0, len(text), 4096)]
-            for i, (chunk, msg_id) in enumerate(zip(chunks, message_ids)):
+            last_idx = len(message_ids) - 1
+            for i, ((start, end), msg_id) in enumerate(zip(self.iter_chunks(text), message_ids)):
+                chunk = text[start:end]
+                chunk_markup = keyboard if i == last_idx else None
                 try:                    
                     if new_mode:
                         await context.bot.edit_message_text(
@@ -838,14 +1159,14 @@ class AIBot:
                             message_id=msg_id,
                             text=chunk,
                             parse_mode=ParseMode.MARKDOWN,
-                            reply_markup=keyboard if i == len(message_ids) - 1 else None
+                            reply_markup=chunk_markup
                         )
                     else:
                         await context.bot.edit_message_text(
                             chat_id=query.message.chat_id,
                             message_id=msg_id,
                             text=chunk,
-                            reply_markup=keyboard if i == len(message_ids) - 1 else None
+                            reply_markup=chunk_markup
                         )
                 except telegram.error.BadRequest as e:
                     if "can't parse entities" in str(e).lower():
@@ -854,7 +1175,7 @@ class AIBot:
                             chat_id=query.message.chat_id,
                             message_id=msg_id,
                             text=f"⚠️ Markdown rendering failed. Some syntax might be invalid:\n\n{chunk}",
-                            reply_markup=keyboard if i == len(message_ids) - 1 else None
+                            reply_markup=chunk_markup
                         )
                     else:
                         raise
@@ -879,9 +1200,9 @@ class AIBot:
         url = f"{self.api_url}:countTokens?key={self.config.gemini_api_key}"
         
         try:
-            response = requests.post(url, headers=self.headers, json={"contents": contents})
-            response.raise_for_status()
-            return response.json().get("totalTokens", 0)
+            async with self.gemini_semaphore, self.get_gemini_session().post(url, json={"contents": contents}) as response:
+                response.raise_for_status()
+                return (await response.json()).get("totalTokens", 0)
         except Exception as e:
             print(f"Error counting tokens: {str(e).replace(self.config.gemini_api_key, '[REDACTED]')}")
             return 0
@@ -896,6 +1217,7 @@ class AIBot:
                 # Remove oldest messages while preserving system instruction
                 if len(history) > 1:
                     history.pop(1)  # Keep system instruction at index 0
+                self.chat_history[user_id].rewrite_log = True
                 total_tokens = await self.count_tokens(history)
     
     def run(self) -> None:
@@ -906,7 +1228,8 @@ class AIBot:
                     self.config.telegram_token).get_updates_read_timeout(30).
                 get_updates_write_timeout(30).get_updates_connect_timeout(30).
                 get_updates_pool_timeout(30).read_timeout(30).write_timeout(
-                    30).connect_timeout(30).pool_timeout(30).build())
+                    30).connect_timeout(30).pool_timeout(30).concurrent_updates(
+                        True).post_shutdown(self.shutdown).build())
 
             # Register handlers
             application.add_handler(CommandHandler("start", self.start))
@@ -936,6 +1259,13 @@ class AIBot:
             raise
 
 if __name__ == "__main__":
+    # uvloop is an optional, faster event loop; it is not available on Windows
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
     config_editor()
     bot = AIBot()
     bot.run()
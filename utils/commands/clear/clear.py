@@ -5,6 +5,9 @@ import os
 import re
 import shutil
 
+CLEARED_TEXT = "💬 Chat history cleared successfully."
+CLEAR_FAILED_TEXT = "⚠️ Failed to fully clear history. Some data might remain."
+
 async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear command handler for new directory structure."""
     user_id = str(update.effective_user.id)
@@ -15,32 +18,42 @@ async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Get user directory path
     user_dir = os.path.join("data", "users", f"{sanitized_username}_{user_id}")
-    history_path = os.path.join(user_dir, "history", "chat_history.pkl")
+    history_dir = os.path.join(user_dir, "history")
+    history_paths = [os.path.join(history_dir, name)
+                     for name in (self.HISTORY_FILENAME, self.LEGACY_HISTORY_FILENAME)]
 
-    # Clear in-memory history
-    if user_id in self.chat_history:
-        del self.chat_history[user_id]
-    
-    # Clear persistent history
-    try:
-        if os.path.exists(history_path):
-            os.remove(history_path)
+    # Wait for any in-progress turn of this user before dropping its chat
+    async with self.get_user_lock(user_id):
+        # Clear in-memory history
+        await self.cancel_pending_save(user_id)
+        if user_id in self.chat_history:
+            del self.chat_history[user_id]
+        
+        # Clear persistent history
+        try:
+            for history_path in history_paths:
+                if os.path.exists(history_path):
+                    os.remove(history_path)
             # Optional: Clean up empty directories
-            if not os.listdir(os.path.dirname(history_path)):
-                os.rmdir(os.path.dirname(history_path))
-            if not os.listdir(user_dir):
+            if os.path.isdir(history_dir) and not os.listdir(history_dir):
+                os.rmdir(history_dir)
+            if os.path.isdir(user_dir) and not os.listdir(user_dir):
                 shutil.rmtree(user_dir)
-    except Exception as e:
-        print(f"Error clearing history: {str(e)}")
+            cleared = True
+        except Exception as e:
+            cleared = False
+            print(f"Error clearing history: {str(e)}")
+
+    if not cleared:
         await self.retry_operation(
             update.message.reply_text,
-            "⚠️ Failed to fully clear history. Some data might remain.",
+            CLEAR_FAILED_TEXT,
             parse_mode='HTML'
         )
         return
 
     await self.retry_operation(
         update.message.reply_text,
-        "💬 Chat history cleared successfully.",
+        CLEARED_TEXT,
         parse_mode='HTML'
     )
@@ -1,9 +1,7 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 
-async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Help command handler."""
-    help_text = """
+HELP_TEXT = """
 <b>Available Commands</b>
 
 • /start - Start the bot
@@ -17,4 +15,7 @@ async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE)
 • /jailbreak - Load jailbreak prompt
 • /web2md [url] - Convert webpage to Markdown
 """
-    await self.retry_operation(update.message.reply_text, help_text, parse_mode='HTML')
\ No newline at end of file
+
+async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Help command handler."""
+    await self.retry_operation(update.message.reply_text, HELP_TEXT, parse_mode='HTML')
\ No newline at end of file
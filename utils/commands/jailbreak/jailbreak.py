@@ -77,12 +77,14 @@ class JailbreakHandler:
             user_id = str(query.from_user.id)
             username = str(query.from_user.username)
             
-            # Send jailbreak prompt to the chat
-            chat = bot.chat_history[user_id]
-            await chat.send_message_async(jailbreak_prompt, role="system")
-            
-            # Save chat history
-            await bot.save_chat_history(user_id, username)
+            # Pin the jailbreak prompt next to the system instruction so history
+            # trimming and summaries never drop it
+            async with bot.get_user_lock(user_id):
+                chat = await bot.initialize_chat(user_id, username)
+                chat.pin(jailbreak_prompt)
+                
+                # Save chat history
+                bot.schedule_save_chat_history(user_id, username, chat)
             
             # Confirm prompt selection
             await bot.send_response_with_toggle(
@@ -117,7 +119,8 @@ async def jailbreak_command(bot, update: Update, context: ContextTypes.DEFAULT_T
     # Ensure user has a chat history
     user_id = str(update.effective_user.id)
     username = str(update.effective_user.username)
-    await bot.initialize_chat(user_id, username)
+    async with bot.get_user_lock(user_id):
+        await bot.initialize_chat(user_id, username)
     
     await JailbreakHandler.list_jailbreaks(bot, update, context)
 
@@ -7,6 +7,12 @@ import json
 import re
 import shutil
 
+WELCOME_TEMPLATE = (
+    "Welcome {first_name}!\n"
+    "I'm your AkiBot. Send me text, images, documents or audio and I will respond.\n"
+    "Use /help for more info."
+)
+
 async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start command handler with user logging functionality."""
     user = update.effective_user
@@ -89,5 +95,5 @@ async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE
     # Send welcome message
     await self.retry_operation(
         update.message.reply_text,
-        f"""Welcome {user.first_name}!\nI'm your AkiBot. Send me text, images, documents or audio and I will respond.\nUse /help for more info."""
+        WELCOME_TEMPLATE.format(first_name=user.first_name)
     )
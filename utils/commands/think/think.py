@@ -1,6 +1,7 @@
 # think.py v1.6.0
 import tempfile
-import requests
+import asyncio
+import aiohttp
 import json
 import telegram
 from telegram import Update
@@ -49,14 +50,16 @@ class ThinkCommand:
                 "maxOutputTokens": 8192,
                 "responseMimeType": "text/plain"
             },
-            "safetySettings": [{"category": k, "threshold": v} for k, v in bot.config.safety_settings.items()]
+            "safetySettings": bot.config.safety_settings_payload
         }
 
         try:
-            response = requests.post(url, json=payload, timeout=20)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            async with bot.gemini_semaphore, bot.get_gemini_session().post(
+                url, json=payload, timeout=aiohttp.ClientTimeout(total=20)
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise RuntimeError(f"API request failed: {str(e)}") from e
 
     def _parse_response(self, response: dict) -> Tuple[str, str]:
@@ -15,13 +15,16 @@ from telegram.ext import ContextTypes
 import asyncio
 import unicodedata
 
+# Video ids are always 11 characters; the short form is tried first
+_YT_SHORT = re.compile(r'youtu\.be/([a-zA-Z0-9_-]{11})')
+_YT_WATCH = re.compile(r'youtube\.com/watch\?v=([a-zA-Z0-9_-]{11})')
+
 class YouTubeDownloader:
+    YOUTUBE_URL_PATTERNS = (_YT_SHORT, _YT_WATCH)
+
     def __init__(self, timeout: int = 300):
         self.download_dir = "youtube_media"
         self.timeout = timeout
-        self.YOUTUBE_URL_REGEX = re.compile(
-            r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/)([a-zA-Z0-9_-]+)'
-        )
         
         # Get the absolute path to the ffmpeg binary
         # current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -49,9 +52,10 @@ class YouTubeDownloader:
 
     def _get_video_id(self, url: str) -> Optional[str]:
         """Extract video ID from URL."""
-        match = self.YOUTUBE_URL_REGEX.search(url)
-        if match:
-            return match.group(1)
+        for pattern in self.YOUTUBE_URL_PATTERNS:
+            match = pattern.search(url)
+            if match:
+                return match.group(1)
         return None
 
     async def download_audio(self, url: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[bytes]]: